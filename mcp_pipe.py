@@ -1,7 +1,9 @@
 import asyncio
+import collections
 import json
 import logging
 import os
+import random
 import signal
 import sys
 import websockets
@@ -14,16 +16,105 @@ logging.basicConfig(
 )
 logger = logging.getLogger("mcp_pipe")
 
+READ_CHUNK_SIZE = 65536
+STREAM_LIMIT = 1 << 20
+# Bound on messages buffered in each direction. When a queue is full the
+# reader stops pulling from its source: the subprocess StreamReader then
+# pauses its pipe transport once more than 2 * STREAM_LIMIT (2 MiB) is
+# buffered, and websockets stops reading the socket after max_queue frames
+# (its outgoing side is bounded separately by write_limit, see
+# connect_websocket), so backpressure reaches the peer instead of growing
+# memory here.
+QUEUE_MAXSIZE = 256
+
+
+class PipeClosed(Exception):
+    """Raised by a writer task once its input has ended, ending the session."""
+
+
+class MessageChannel:
+    """Bounded queue for exactly one producer task and one consumer task.
+
+    asyncio.Queue keeps waiter deques for any number of getters and putters;
+    with a single task on each side a deque plus one waiter future per side is
+    enough, and the consumer takes everything queued in one call.
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._items = collections.deque()
+        self._getter = None
+        self._putter = None
+
+    def qsize(self):
+        return len(self._items)
+
+    def full(self):
+        return len(self._items) >= self.maxsize
+
+    @staticmethod
+    def _wake(waiter):
+        if waiter is not None and not waiter.done():
+            waiter.set_result(None)
+
+    async def put(self, item):
+        while self.full():
+            self._putter = asyncio.get_running_loop().create_future()
+            await self._putter
+        self._items.append(item)
+        waiter, self._getter = self._getter, None
+        self._wake(waiter)
+
+    async def get_batch(self):
+        """Wait until at least one item is queued, then return all of them."""
+        while not self._items:
+            self._getter = asyncio.get_running_loop().create_future()
+            await self._getter
+        batch = list(self._items)
+        self._items.clear()
+        waiter, self._putter = self._putter, None
+        self._wake(waiter)
+        return batch
+
 
 class MCPPipe:
+    """Bridges the MCP server's stdio to the Xiaozhi WebSocket endpoint.
+
+    The WebSocket is opened with permessage-deflate disabled. MCP traffic is
+    small JSON-RPC messages that barely compress, and deflate adds CPU per
+    frame and raises per-connection memory from roughly 14 KiB to 64 KiB. If
+    bandwidth ever matters more than that, prefer compression="deflate" with a
+    reduced window (max_window_bits=10) over the default settings.
+    """
+
     def __init__(self, script_path, token):
         self.script_path = script_path
         self.token = token.strip()  # Remove any whitespace
         self.ws = None
         self.process = None
         self.running = False
-        self.reconnect_delay = 1
+        self.base_reconnect_delay = 1
         self.max_reconnect_delay = 60
+        self._attempt = 0
+        self._stop_evt = asyncio.Event()
+        self._p2w_q = None
+        self._w2p_q = None
+        self._backpressured = set()
+
+    def _next_backoff(self):
+        # Full jitter: sleep a random time up to the capped exponential delay,
+        # so clients dropped together do not all retry at the same moment.
+        cap = min(self.max_reconnect_delay, self.base_reconnect_delay * 2 ** self._attempt)
+        delay = random.uniform(0, cap)
+        self._attempt += 1
+        return delay
+
+    async def _sleep(self, delay):
+        """Sleep for delay seconds, returning early if stop() is called."""
+        try:
+            await asyncio.wait_for(self._stop_evt.wait(), timeout=delay)
+        except asyncio.TimeoutError:
+            pass
 
     async def start_mcp_process(self):
         logger.info(f"Starting MCP process: {self.script_path}")
@@ -33,8 +124,10 @@ class MCPPipe:
             self.script_path,
             stdin=asyncio.subprocess.PIPE,
             stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE
+            stderr=asyncio.subprocess.PIPE,
+            limit=STREAM_LIMIT
         )
+        self.process.stdin.transport.set_write_buffer_limits(high=STREAM_LIMIT)
         
         logger.info(f"MCP process started with PID: {self.process.pid}")
         return self.process
@@ -49,10 +142,13 @@ class MCPPipe:
             self.ws = await websockets.connect(
                 uri,
                 ping_interval=20,
-                ping_timeout=10
+                ping_timeout=10,
+                compression=None,
+                max_size=2 ** 20,
+                write_limit=2 ** 16
             )
             logger.info("WebSocket connected successfully")
-            self.reconnect_delay = 1
+            self._attempt = 0
             return True
         except Exception as e:
             logger.error(f"WebSocket connection failed: {e}")
@@ -61,44 +157,81 @@ class MCPPipe:
                 logger.error("Get your token from: https://api.xiaozhi.me or your Xiaozhi account settings")
             return False
 
+    async def read_lines(self, stream):
+        """Yield newline-delimited lines from stream, reading it in large chunks."""
+        buf = bytearray()
+        while True:
+            data = await stream.read(READ_CHUNK_SIZE)
+            if not data:
+                if buf:
+                    yield bytes(buf)
+                return
+            
+            buf.extend(data)
+            start = 0
+            # Copy each line out exactly once, and compact the buffer once per chunk
+            with memoryview(buf) as view:
+                while (nl := buf.find(b"\n", start)) != -1:
+                    yield bytes(view[start:nl + 1])
+                    start = nl + 1
+            del buf[:start]
+
+    async def _enqueue(self, queue, item, direction):
+        if queue.full():
+            if direction not in self._backpressured:
+                self._backpressured.add(direction)
+                logger.warning(f"{direction} queue full ({queue.maxsize}), pausing reads until it drains")
+        elif direction in self._backpressured and queue.qsize() <= queue.maxsize // 2:
+            self._backpressured.discard(direction)
+            logger.info(f"{direction} queue drained, reads resumed")
+        await queue.put(item)
+
     async def read_from_process(self):
         try:
-            while self.running:
-                if not self.process or not self.process.stdout:
-                    await asyncio.sleep(0.1)
-                    continue
-                
-                line = await self.process.stdout.readline()
-                if not line:
+            async for line in self.read_lines(self.process.stdout):
+                if self._stop_evt.is_set():
                     break
                 
                 try:
-                    message = line.decode().strip()
-                    if message:
-                        logger.info(f"Process -> WS: {message[:100]}...")
-                        
-                        if self.ws and self.ws.open:
-                            await self.ws.send(message)
+                    # Strip on bytes so blank lines are never decoded. The
+                    # decode itself stays: Xiaozhi expects JSON-RPC in text
+                    # frames, and websockets sends bytes as binary frames.
+                    line = line.strip()
+                    if line:
+                        message = line.decode()
+                        logger.info("Process -> WS: %.100s...", message)
+                        await self._enqueue(self._p2w_q, message, "Process -> WS")
                 except Exception as e:
                     logger.error(f"Error processing message from MCP: {e}")
                     
         except Exception as e:
             logger.error(f"Error reading from process: {e}")
+        
+        # None tells the writer there is nothing more to send.
+        await self._p2w_q.put(None)
+
+    async def write_to_websocket(self):
+        # Each MCP line is its own JSON-RPC message, so a batch is sent as
+        # consecutive frames rather than joined into one.
+        while not self._stop_evt.is_set():
+            batch = await self._p2w_q.get_batch()
+            for message in batch:
+                if message is None:
+                    raise PipeClosed("MCP process output ended")
+                await self.ws.send(message)
+        
+        raise PipeClosed("Pipe stopped")
 
     async def read_from_websocket(self):
         try:
-            while self.running:
-                if not self.ws or not self.ws.open:
-                    await asyncio.sleep(0.1)
-                    continue
-                
+            while not self._stop_evt.is_set():
                 try:
                     message = await self.ws.recv()
-                    logger.info(f"WS -> Process: {message[:100]}...")
+                    logger.info("WS -> Process: %.100s...", message)
                     
-                    if self.process and self.process.stdin:
-                        self.process.stdin.write(f"{message}\n".encode())
-                        await self.process.stdin.drain()
+                    if isinstance(message, str):
+                        message = message.encode()
+                    await self._enqueue(self._w2p_q, message, "WS -> Process")
                         
                 except websockets.exceptions.ConnectionClosed:
                     logger.warning("WebSocket connection closed")
@@ -109,27 +242,40 @@ class MCPPipe:
                     
         except Exception as e:
             logger.error(f"Error in WebSocket reader: {e}")
+        
+        await self._w2p_q.put(None)
+
+    async def write_to_process(self):
+        # Write everything queued, then drain once per batch.
+        while not self._stop_evt.is_set():
+            batch = await self._w2p_q.get_batch()
+            for message in batch:
+                if message is None:
+                    raise PipeClosed("WebSocket input ended")
+                self.process.stdin.write(message + b"\n")
+            await self.process.stdin.drain()
+        
+        raise PipeClosed("Pipe stopped")
 
     async def read_process_stderr(self):
         try:
-            while self.running:
-                if not self.process or not self.process.stderr:
-                    await asyncio.sleep(0.1)
-                    continue
-                
-                line = await self.process.stderr.readline()
-                if not line:
+            async for line in self.read_lines(self.process.stderr):
+                if self._stop_evt.is_set():
                     break
+                # Keep draining the pipe, but skip decoding if nothing will be logged
+                if not logger.isEnabledFor(logging.INFO):
+                    continue
                 
                 log_message = line.decode().strip()
                 if log_message:
-                    logger.info(f"[MCP STDERR] {log_message}")
+                    logger.info("[MCP STDERR] %s", log_message)
                     
         except Exception as e:
             logger.error(f"Error reading stderr: {e}")
 
     async def run(self):
         self.running = True
+        self._stop_evt.clear()
         
         while self.running:
             try:
@@ -137,41 +283,49 @@ class MCPPipe:
                 
                 connected = await self.connect_websocket()
                 if not connected:
-                    logger.warning(f"Retrying connection in {self.reconnect_delay}s...")
-                    await asyncio.sleep(self.reconnect_delay)
-                    self.reconnect_delay = min(self.reconnect_delay * 2, self.max_reconnect_delay)
                     continue
                 
-                tasks = [
-                    asyncio.create_task(self.read_from_process()),
-                    asyncio.create_task(self.read_from_websocket()),
-                    asyncio.create_task(self.read_process_stderr())
-                ]
+                self._p2w_q = MessageChannel(QUEUE_MAXSIZE)
+                self._w2p_q = MessageChannel(QUEUE_MAXSIZE)
                 
-                await asyncio.gather(*tasks, return_exceptions=True)
+                # The readers hand None to their writer when their source ends;
+                # a writer then raises PipeClosed (or a send fails), and the
+                # TaskGroup cancels every other task before we reconnect.
+                async with asyncio.TaskGroup() as tg:
+                    tg.create_task(self.read_from_process())
+                    tg.create_task(self.write_to_websocket())
+                    tg.create_task(self.read_from_websocket())
+                    tg.create_task(self.write_to_process())
+                    tg.create_task(self.read_process_stderr())
                 
-            except Exception as e:
-                logger.error(f"Error in main loop: {e}")
+            except* PipeClosed as eg:
+                logger.info(f"Session ended: {eg.exceptions[0]}")
+            except* (websockets.exceptions.ConnectionClosed, BrokenPipeError, ConnectionResetError) as eg:
+                logger.warning(f"Connection lost: {eg.exceptions[0]!r}")
+            except* Exception as eg:
+                for e in eg.exceptions:
+                    logger.error(f"Error in main loop: {e}")
             finally:
                 if self.ws:
                     await self.ws.close()
-                if self.process:
+                if self.process and self.process.returncode is None:
                     self.process.terminate()
                     await self.process.wait()
                 
                 if self.running:
-                    logger.info(f"Reconnecting in {self.reconnect_delay}s...")
-                    await asyncio.sleep(self.reconnect_delay)
-                    self.reconnect_delay = min(self.reconnect_delay * 2, self.max_reconnect_delay)
+                    delay = self._next_backoff()
+                    logger.info(f"Reconnecting in {delay:.1f}s...")
+                    await self._sleep(delay)
 
     async def stop(self):
         logger.info("Stopping MCP Pipe...")
         self.running = False
+        self._stop_evt.set()
         
         if self.ws:
             await self.ws.close()
         
-        if self.process:
+        if self.process and self.process.returncode is None:
             self.process.terminate()
             try:
                 await asyncio.wait_for(self.process.wait(), timeout=5)
@@ -217,17 +371,21 @@ async def main():
     
     pipe = MCPPipe(script_path, token)
     
-    def signal_handler(signum, frame):
-        logger.info(f"Received signal {signum}")
-        asyncio.create_task(pipe.stop())
+    loop = asyncio.get_running_loop()
+    # The loop only keeps weak references to tasks, so hold on to these
+    shutdown_tasks = set()
+    
+    def signal_handler(sig):
+        logger.info(f"Received signal {sig.name}")
+        task = asyncio.create_task(pipe.stop())
+        shutdown_tasks.add(task)
+        task.add_done_callback(shutdown_tasks.discard)
     
-    signal.signal(signal.SIGINT, signal_handler)
-    signal.signal(signal.SIGTERM, signal_handler)
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, signal_handler, sig)
     
     try:
         await pipe.run()
-    except KeyboardInterrupt:
-        logger.info("Keyboard interrupt received")
     finally:
         await pipe.stop()
 
@@ -1,8 +1,19 @@
+import os
 import sys
-import json
+import re
+import time
+import queue
+import signal
 import logging
+import sqlite3
+import functools
+import heapq
+import threading
+from dataclasses import dataclass, field
 from datetime import datetime, timedelta
+import orjson
 from mcp.server.fastmcp import FastMCP
+from sortedcontainers import SortedKeyList
 
 logging.basicConfig(
     level=logging.INFO,
@@ -13,9 +24,230 @@ logger = logging.getLogger("reminder_server")
 
 mcp = FastMCP("Xiaozhi Reminder Server")
 
-reminders = {}
+
+@dataclass(slots=True)
+class Reminder:
+    id: str
+    title: str
+    description: str
+    dt: datetime
+    completed: bool = False
+    created_at: datetime = field(default_factory=datetime.now)
+    completed_at: datetime | None = None
+    title_lc: str = field(init=False)
+    desc_lc: str = field(init=False)
+
+    def __post_init__(self):
+        # Lowercased once for search_reminders
+        self.title_lc = self.title.lower()
+        self.desc_lc = self.description.lower()
+
+    def to_dict(self):
+        data = {
+            "id": self.id,
+            "title": self.title,
+            "description": self.description,
+            "datetime": self.dt.isoformat(),
+            "completed": self.completed,
+            "created_at": self.created_at.isoformat()
+        }
+        if self.completed_at is not None:
+            data["completed_at"] = self.completed_at.isoformat()
+        return data
+
+
+reminders: dict[str, Reminder] = {}
 reminder_counter = 0
 
+# (datetime, id) of every reminder not yet completed, ordered by datetime
+pending_index = SortedKeyList(key=lambda item: item[0])
+
+
+class DueCounter:
+    """Running counts of pending reminders that are overdue or due within a window.
+
+    Each reminder sits in a min-heap keyed on the moment it next changes state,
+    so advance() only touches reminders whose deadline has passed since the last
+    call. Removed reminders are dropped lazily when their heap entries surface.
+    """
+
+    def __init__(self, window=timedelta(hours=24)):
+        self.window = window
+        self.overdue = 0
+        self.upcoming = 0
+        self._stage = {}
+        self._becomes_upcoming = []
+        self._becomes_overdue = []
+
+    def add(self, reminder_id, reminder_dt, now):
+        heapq.heappush(self._becomes_overdue, (reminder_dt, reminder_id))
+        if reminder_dt < now:
+            self._stage[reminder_id] = "overdue"
+            self.overdue += 1
+        elif reminder_dt <= now + self.window:
+            self._stage[reminder_id] = "upcoming"
+            self.upcoming += 1
+        else:
+            self._stage[reminder_id] = "later"
+            heapq.heappush(self._becomes_upcoming, (reminder_dt - self.window, reminder_id))
+
+    def remove(self, reminder_id):
+        stage = self._stage.pop(reminder_id, None)
+        if stage == "overdue":
+            self.overdue -= 1
+        elif stage == "upcoming":
+            self.upcoming -= 1
+
+    def advance(self, now):
+        while self._becomes_upcoming and self._becomes_upcoming[0][0] <= now:
+            _, reminder_id = heapq.heappop(self._becomes_upcoming)
+            if self._stage.get(reminder_id) == "later":
+                self._stage[reminder_id] = "upcoming"
+                self.upcoming += 1
+        
+        while self._becomes_overdue and self._becomes_overdue[0][0] < now:
+            _, reminder_id = heapq.heappop(self._becomes_overdue)
+            stage = self._stage.get(reminder_id)
+            if stage == "upcoming":
+                self.upcoming -= 1
+            if stage in ("later", "upcoming"):
+                self._stage[reminder_id] = "overdue"
+                self.overdue += 1
+
+
+due_counter = DueCounter()
+
+
+class ReminderStore:
+    """SQLite persistence for the in-memory reminders.
+
+    The table is read once at startup; afterwards every write is handed to a
+    single background thread that commits in batches, so tool calls never wait
+    on disk.
+    """
+
+    COLUMNS = ("id", "title", "description", "datetime", "completed", "created_at", "completed_at")
+
+    def __init__(self, path, commit_interval=0.1):
+        self.path = path
+        self.commit_interval = commit_interval
+        self._queue = queue.Queue()
+        
+        conn = sqlite3.connect(path)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS reminders ("
+            "id TEXT PRIMARY KEY, title TEXT NOT NULL, description TEXT NOT NULL, "
+            "datetime TEXT NOT NULL, completed INTEGER NOT NULL, "
+            "created_at TEXT NOT NULL, completed_at TEXT)"
+        )
+        conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+        conn.commit()
+        conn.close()
+        
+        self._thread = threading.Thread(target=self._write_loop, name="reminder-store", daemon=True)
+        self._thread.start()
+
+    def load(self):
+        conn = sqlite3.connect(self.path)
+        try:
+            rows = conn.execute(f"SELECT {', '.join(self.COLUMNS)} FROM reminders").fetchall()
+        finally:
+            conn.close()
+        
+        return [
+            Reminder(
+                id=reminder_id,
+                title=title,
+                description=description,
+                dt=datetime.fromisoformat(dt),
+                completed=bool(completed),
+                created_at=datetime.fromisoformat(created_at),
+                completed_at=datetime.fromisoformat(completed_at) if completed_at else None
+            )
+            for reminder_id, title, description, dt, completed, created_at, completed_at in rows
+        ]
+
+    def last_id(self):
+        """Highest numeric reminder ID ever saved, including deleted ones."""
+        conn = sqlite3.connect(self.path)
+        try:
+            row = conn.execute("SELECT value FROM meta WHERE key = 'last_id'").fetchone()
+        finally:
+            conn.close()
+        return row[0] if row else 0
+
+    def save(self, reminder):
+        self._queue.put(("save", (
+            reminder.id,
+            reminder.title,
+            reminder.description,
+            reminder.dt.isoformat(),
+            int(reminder.completed),
+            reminder.created_at.isoformat(),
+            reminder.completed_at.isoformat() if reminder.completed_at else None
+        )))
+
+        if reminder.id.isdigit():
+            self._queue.put(("last_id", int(reminder.id)))
+
+    def delete(self, reminder_id):
+        self._queue.put(("delete", reminder_id))
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+
+    def _write_loop(self):
+        conn = sqlite3.connect(self.path)
+        conn.execute("PRAGMA synchronous=NORMAL")
+        placeholders = ", ".join("?" * len(self.COLUMNS))
+        upsert = f"INSERT OR REPLACE INTO reminders ({', '.join(self.COLUMNS)}) VALUES ({placeholders})"
+        bump_last_id = (
+            "INSERT INTO meta (key, value) VALUES ('last_id', ?) "
+            "ON CONFLICT(key) DO UPDATE SET value = MAX(value, excluded.value)"
+        )
+        
+        while True:
+            item = self._queue.get()
+            deadline = time.monotonic() + self.commit_interval
+            # Apply everything that arrives within commit_interval, then commit once
+            while item is not None:
+                op, arg = item
+                try:
+                    if op == "save":
+                        conn.execute(upsert, arg)
+                    elif op == "last_id":
+                        conn.execute(bump_last_id, (arg,))
+                    else:
+                        conn.execute("DELETE FROM reminders WHERE id = ?", (arg,))
+                except sqlite3.Error as e:
+                    logger.error(f"Error persisting reminder: {e}")
+                
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+            
+            try:
+                conn.commit()
+            except sqlite3.Error as e:
+                # Keep the writer alive; later batches may still succeed
+                logger.error(f"Error committing reminders: {e}")
+                try:
+                    conn.rollback()
+                except sqlite3.Error:
+                    pass
+            if item is None:
+                conn.close()
+                return
+
+
+store = None
+
 
 def get_next_id():
     global reminder_counter
@@ -23,7 +255,78 @@ def get_next_id():
     return str(reminder_counter)
 
 
+def _track(reminder, now):
+    """Register a stored reminder with the pending index and due counter."""
+    if not reminder.completed:
+        pending_index.add((reminder.dt, reminder.id))
+        due_counter.add(reminder.id, reminder.dt, now)
+
+
+def _persist(reminder):
+    if store:
+        store.save(reminder)
+
+
+def _persist_delete(reminder_id):
+    if store:
+        store.delete(reminder_id)
+
+
+def load_reminders(path):
+    """Open the reminder database at path and load its contents into memory."""
+    global store, reminder_counter
+    store = ReminderStore(path)
+    # IDs are never reused, even for reminders deleted before a restart
+    reminder_counter = max(reminder_counter, store.last_id())
+    now = datetime.now()
+    
+    for reminder in store.load():
+        reminders[reminder.id] = reminder
+        _track(reminder, now)
+        # Databases written before the meta table existed have no last_id
+        if reminder.id.isdigit():
+            reminder_counter = max(reminder_counter, int(reminder.id))
+    
+    logger.info(f"Loaded {len(reminders)} reminder(s) from {path}")
+
+
+def _ok(**fields):
+    return orjson.dumps({"success": True, **fields}).decode()
+
+
+def _err(error):
+    return orjson.dumps({"success": False, "error": error}).decode()
+
+
+# Fast path for the formats accepted below; the field order depends on the
+# separator, e.g. 2024-01-31 (Y-m-d), 31-01-2024 (d-m-Y), 01/31/2024 (m/d/Y).
+_DT_RE = re.compile(
+    r"^(?:(?P<ymd_y>\d{4})(?P<ymd_sep>[-/])(?P<ymd_m>\d{1,2})(?P=ymd_sep)(?P<ymd_d>\d{1,2})"
+    r"|(?P<dmy_d>\d{1,2})-(?P<dmy_m>\d{1,2})-(?P<dmy_y>\d{4})"
+    r"|(?P<mdy_m>\d{1,2})/(?P<mdy_d>\d{1,2})/(?P<mdy_y>\d{4}))"
+    r" (?P<H>\d{1,2}):(?P<M>\d{1,2})(?::(?P<S>\d{1,2}))?$"
+)
+
+
+@functools.lru_cache(maxsize=1024)
 def parse_datetime(datetime_str):
+    m = _DT_RE.match(datetime_str.strip())
+    if m:
+        g = m.groupdict()
+        for order in ("ymd", "dmy", "mdy"):
+            if g[f"{order}_y"]:
+                break
+        seconds = g["S"]
+        # Seconds are only accepted in the YYYY-MM-DD form
+        if seconds is None or g["ymd_sep"] == "-":
+            try:
+                return datetime(
+                    int(g[f"{order}_y"]), int(g[f"{order}_m"]), int(g[f"{order}_d"]),
+                    int(g["H"]), int(g["M"]), int(seconds or 0)
+                )
+            except ValueError:
+                pass
+    
     formats = [
         "%Y-%m-%d %H:%M",
         "%Y-%m-%d %H:%M:%S",
@@ -46,42 +349,35 @@ def add_reminder(title: str, datetime_str: str, description: str = ""):
     """Add a new reminder with title, datetime (YYYY-MM-DD HH:MM), and optional description"""
     try:
         reminder_time = parse_datetime(datetime_str)
+        now = datetime.now()
         
-        if reminder_time < datetime.now():
-            return json.dumps({
-                "success": False,
-                "error": "Cannot create reminder for past time"
-            }, indent=2)
+        if reminder_time < now:
+            return _err("Cannot create reminder for past time")
         
         reminder_id = get_next_id()
-        reminders[reminder_id] = {
-            "id": reminder_id,
-            "title": title,
-            "description": description,
-            "datetime": reminder_time.isoformat(),
-            "completed": False,
-            "created_at": datetime.now().isoformat()
-        }
+        reminder = Reminder(
+            id=reminder_id,
+            title=title,
+            description=description,
+            dt=reminder_time,
+            created_at=now
+        )
+        reminders[reminder_id] = reminder
+        _track(reminder, now)
+        _persist(reminder)
         
         logger.info(f"Added reminder: {reminder_id} - {title}")
         
-        return json.dumps({
-            "success": True,
-            "message": "Reminder added successfully",
-            "reminder": reminders[reminder_id]
-        }, indent=2)
+        return _ok(
+            message="Reminder added successfully",
+            reminder=reminder.to_dict()
+        )
         
     except ValueError as e:
-        return json.dumps({
-            "success": False,
-            "error": str(e)
-        }, indent=2)
+        return _err(str(e))
     except Exception as e:
         logger.error(f"Error adding reminder: {e}")
-        return json.dumps({
-            "success": False,
-            "error": f"Failed to add reminder: {str(e)}"
-        }, indent=2)
+        return _err(f"Failed to add reminder: {str(e)}")
 
 
 @mcp.tool()
@@ -90,35 +386,27 @@ def list_reminders(include_completed: str = "false"):
     try:
         show_completed = include_completed.lower() == "true"
         
-        filtered_reminders = [
-            r for r in reminders.values()
-            if show_completed or not r["completed"]
-        ]
+        if show_completed:
+            ordered = sorted(reminders.values(), key=lambda x: x.dt)
+        else:
+            ordered = [reminders[rid] for _, rid in pending_index]
         
-        if not filtered_reminders:
-            return json.dumps({
-                "success": True,
-                "message": "No reminders found",
-                "reminders": []
-            }, indent=2)
+        if not ordered:
+            return _ok(
+                message="No reminders found",
+                reminders=[]
+            )
         
-        sorted_reminders = sorted(
-            filtered_reminders,
-            key=lambda x: x["datetime"]
-        )
+        sorted_reminders = [r.to_dict() for r in ordered]
         
-        return json.dumps({
-            "success": True,
-            "count": len(sorted_reminders),
-            "reminders": sorted_reminders
-        }, indent=2)
+        return _ok(
+            count=len(sorted_reminders),
+            reminders=sorted_reminders
+        )
         
     except Exception as e:
         logger.error(f"Error listing reminders: {e}")
-        return json.dumps({
-            "success": False,
-            "error": f"Failed to list reminders: {str(e)}"
-        }, indent=2)
+        return _err(f"Failed to list reminders: {str(e)}")
 
 
 @mcp.tool()
@@ -130,39 +418,25 @@ def get_upcoming_reminders(hours: str = "24"):
         future_time = now + timedelta(hours=hours_int)
         
         upcoming = []
-        for reminder in reminders.values():
-            if reminder["completed"]:
-                continue
-                
-            reminder_dt = datetime.fromisoformat(reminder["datetime"])
-            if now <= reminder_dt <= future_time:
-                time_until = reminder_dt - now
-                hours_until = time_until.total_seconds() / 3600
-                
-                reminder_copy = reminder.copy()
-                reminder_copy["hours_until"] = round(hours_until, 1)
-                upcoming.append(reminder_copy)
-        
-        upcoming.sort(key=lambda x: x["datetime"])
-        
-        return json.dumps({
-            "success": True,
-            "count": len(upcoming),
-            "time_window_hours": hours_int,
-            "reminders": upcoming
-        }, indent=2)
+        for reminder_dt, rid in pending_index.irange_key(now, future_time):
+            time_until = reminder_dt - now
+            hours_until = time_until.total_seconds() / 3600
+            
+            reminder_copy = reminders[rid].to_dict()
+            reminder_copy["hours_until"] = round(hours_until, 1)
+            upcoming.append(reminder_copy)
+        
+        return _ok(
+            count=len(upcoming),
+            time_window_hours=hours_int,
+            reminders=upcoming
+        )
         
     except ValueError:
-        return json.dumps({
-            "success": False,
-            "error": "Hours must be a valid number"
-        }, indent=2)
+        return _err("Hours must be a valid number")
     except Exception as e:
         logger.error(f"Error getting upcoming reminders: {e}")
-        return json.dumps({
-            "success": False,
-            "error": f"Failed to get upcoming reminders: {str(e)}"
-        }, indent=2)
+        return _err(f"Failed to get upcoming reminders: {str(e)}")
 
 
 @mcp.tool()
@@ -172,41 +446,29 @@ def check_overdue_reminders():
         now = datetime.now()
         overdue = []
         
-        for reminder in reminders.values():
-            if reminder["completed"]:
-                continue
-                
-            reminder_dt = datetime.fromisoformat(reminder["datetime"])
-            if reminder_dt < now:
-                time_overdue = now - reminder_dt
-                hours_overdue = time_overdue.total_seconds() / 3600
-                
-                reminder_copy = reminder.copy()
-                reminder_copy["hours_overdue"] = round(hours_overdue, 1)
-                overdue.append(reminder_copy)
-        
-        overdue.sort(key=lambda x: x["datetime"])
+        for reminder_dt, rid in pending_index.irange_key(max_key=now, inclusive=(True, False)):
+            time_overdue = now - reminder_dt
+            hours_overdue = time_overdue.total_seconds() / 3600
+            
+            reminder_copy = reminders[rid].to_dict()
+            reminder_copy["hours_overdue"] = round(hours_overdue, 1)
+            overdue.append(reminder_copy)
         
         if not overdue:
-            return json.dumps({
-                "success": True,
-                "message": "No overdue reminders",
-                "reminders": []
-            }, indent=2)
-        
-        return json.dumps({
-            "success": True,
-            "count": len(overdue),
-            "message": f"ALERT: You have {len(overdue)} overdue reminder(s)!",
-            "reminders": overdue
-        }, indent=2)
+            return _ok(
+                message="No overdue reminders",
+                reminders=[]
+            )
+        
+        return _ok(
+            count=len(overdue),
+            message=f"ALERT: You have {len(overdue)} overdue reminder(s)!",
+            reminders=overdue
+        )
         
     except Exception as e:
         logger.error(f"Error checking overdue reminders: {e}")
-        return json.dumps({
-            "success": False,
-            "error": f"Failed to check overdue reminders: {str(e)}"
-        }, indent=2)
+        return _err(f"Failed to check overdue reminders: {str(e)}")
 
 
 @mcp.tool()
@@ -214,28 +476,25 @@ def complete_reminder(reminder_id: str):
     """Mark a reminder as completed by its ID"""
     try:
         if reminder_id not in reminders:
-            return json.dumps({
-                "success": False,
-                "error": f"Reminder with ID {reminder_id} not found"
-            }, indent=2)
+            return _err(f"Reminder with ID {reminder_id} not found")
         
-        reminders[reminder_id]["completed"] = True
-        reminders[reminder_id]["completed_at"] = datetime.now().isoformat()
+        reminder = reminders[reminder_id]
+        pending_index.discard((reminder.dt, reminder_id))
+        due_counter.remove(reminder_id)
+        reminder.completed = True
+        reminder.completed_at = datetime.now()
+        _persist(reminder)
         
         logger.info(f"Completed reminder: {reminder_id}")
         
-        return json.dumps({
-            "success": True,
-            "message": "Reminder marked as completed",
-            "reminder": reminders[reminder_id]
-        }, indent=2)
+        return _ok(
+            message="Reminder marked as completed",
+            reminder=reminder.to_dict()
+        )
         
     except Exception as e:
         logger.error(f"Error completing reminder: {e}")
-        return json.dumps({
-            "success": False,
-            "error": f"Failed to complete reminder: {str(e)}"
-        }, indent=2)
+        return _err(f"Failed to complete reminder: {str(e)}")
 
 
 @mcp.tool()
@@ -243,26 +502,22 @@ def delete_reminder(reminder_id: str):
     """Delete a reminder by its ID"""
     try:
         if reminder_id not in reminders:
-            return json.dumps({
-                "success": False,
-                "error": f"Reminder with ID {reminder_id} not found"
-            }, indent=2)
+            return _err(f"Reminder with ID {reminder_id} not found")
         
         deleted_reminder = reminders.pop(reminder_id)
+        pending_index.discard((deleted_reminder.dt, reminder_id))
+        due_counter.remove(reminder_id)
+        _persist_delete(reminder_id)
         logger.info(f"Deleted reminder: {reminder_id}")
         
-        return json.dumps({
-            "success": True,
-            "message": "Reminder deleted successfully",
-            "deleted_reminder": deleted_reminder
-        }, indent=2)
+        return _ok(
+            message="Reminder deleted successfully",
+            deleted_reminder=deleted_reminder.to_dict()
+        )
         
     except Exception as e:
         logger.error(f"Error deleting reminder: {e}")
-        return json.dumps({
-            "success": False,
-            "error": f"Failed to delete reminder: {str(e)}"
-        }, indent=2)
+        return _err(f"Failed to delete reminder: {str(e)}")
 
 
 @mcp.tool()
@@ -273,34 +528,26 @@ def search_reminders(query: str):
         results = []
         
         for reminder in reminders.values():
-            title_match = query_lower in reminder["title"].lower()
-            desc_match = query_lower in reminder["description"].lower()
-            
-            if title_match or desc_match:
+            if query_lower in reminder.title_lc or query_lower in reminder.desc_lc:
                 results.append(reminder)
         
         if not results:
-            return json.dumps({
-                "success": True,
-                "message": f"No reminders found matching '{query}'",
-                "reminders": []
-            }, indent=2)
+            return _ok(
+                message=f"No reminders found matching '{query}'",
+                reminders=[]
+            )
         
-        results.sort(key=lambda x: x["datetime"])
+        results.sort(key=lambda x: x.dt)
         
-        return json.dumps({
-            "success": True,
-            "count": len(results),
-            "query": query,
-            "reminders": results
-        }, indent=2)
+        return _ok(
+            count=len(results),
+            query=query,
+            reminders=[r.to_dict() for r in results]
+        )
         
     except Exception as e:
         logger.error(f"Error searching reminders: {e}")
-        return json.dumps({
-            "success": False,
-            "error": f"Failed to search reminders: {str(e)}"
-        }, indent=2)
+        return _err(f"Failed to search reminders: {str(e)}")
 
 
 @mcp.tool()
@@ -308,42 +555,43 @@ def get_reminder_stats():
     """Get statistics about all reminders"""
     try:
         total = len(reminders)
-        completed = sum(1 for r in reminders.values() if r["completed"])
-        pending = total - completed
+        pending = len(pending_index)
+        completed = total - pending
         
-        now = datetime.now()
-        overdue = 0
-        upcoming_24h = 0
+        due_counter.advance(datetime.now())
+        overdue = due_counter.overdue
+        upcoming_24h = due_counter.upcoming
         
-        for reminder in reminders.values():
-            if reminder["completed"]:
-                continue
-            
-            reminder_dt = datetime.fromisoformat(reminder["datetime"])
-            if reminder_dt < now:
-                overdue += 1
-            elif reminder_dt <= now + timedelta(hours=24):
-                upcoming_24h += 1
-        
-        return json.dumps({
-            "success": True,
-            "stats": {
-                "total_reminders": total,
-                "completed": completed,
-                "pending": pending,
-                "overdue": overdue,
-                "upcoming_24h": upcoming_24h
-            }
-        }, indent=2)
+        return _ok(stats={
+            "total_reminders": total,
+            "completed": completed,
+            "pending": pending,
+            "overdue": overdue,
+            "upcoming_24h": upcoming_24h
+        })
         
     except Exception as e:
         logger.error(f"Error getting stats: {e}")
-        return json.dumps({
-            "success": False,
-            "error": f"Failed to get statistics: {str(e)}"
-        }, indent=2)
+        return _err(f"Failed to get statistics: {str(e)}")
+
+
+def _exit_on_sigterm(signum, frame):
+    # mcp_pipe stops this process with SIGTERM. The stdio transport is blocked
+    # reading stdin in a worker thread, so flush queued writes from a separate
+    # thread (the handler itself may have interrupted a queue operation) and
+    # exit without unwinding the event loop.
+    def flush_and_exit():
+        store.close()
+        os._exit(0)
+    
+    threading.Thread(target=flush_and_exit).start()
 
 
 if __name__ == "__main__":
     logger.info("Starting Xiaozhi Reminder Server...")
-    mcp.run(transport="stdio")
+    load_reminders(os.getenv("REMINDER_DB", "reminders.db"))
+    signal.signal(signal.SIGTERM, _exit_on_sigterm)
+    try:
+        mcp.run(transport="stdio")
+    finally:
+        store.close()